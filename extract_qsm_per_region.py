@@ -1,23 +1,33 @@
 import nibabel as nib
 import argparse
+import functools
 import numpy as np
 import csv
 import os
-from scipy.ndimage import binary_erosion
-
-parser = argparse.ArgumentParser(description='Extract QSM values per brain region from segmentation data.')
-
-parser.add_argument('--id', type=int, help="ID", required=True)
-parser.add_argument('--ses', type=int, help="session", required=True)
-parser.add_argument('--qsm_in_T1', type=str, help="Path to the QSM in T1 space NIfTI file", required=True)
-parser.add_argument('--segmentation', type=str, help="Path to the segmentation MGZ file", required=True)
-parser.add_argument('--qsm_in_mni152', type=str, help="Path to the QSM in MNI152 space NIfTI file", required=True)
-parser.add_argument('--lesions_mask', type=str, help="Path to the lesions mask in T1 space NIfTI file", required=False)
-parser.add_argument('--sn_mask_left', type=str, help="Path to the left SN mask in MNI space", required=True)
-parser.add_argument('--sn_mask_right', type=str, help="Path to the right SN mask in MNI space", required=True)
-parser.add_argument('--output_csv', type=str, help="Path to the output CSV file", required=True)
-
-args = parser.parse_args()
+from concurrent.futures import ProcessPoolExecutor
+from scipy.ndimage import find_objects, maximum_filter1d, minimum_filter1d, value_indices
+
+# Numba is optional: when present, the per-label erosion + value gather runs
+# as a single compiled sweep instead of separate filter and indexing passes.
+try:
+    from numba import njit, prange
+    _HAVE_NUMBA = True
+except ImportError:
+    _HAVE_NUMBA = False
+
+# OpenCV is optional: its SIMD/multithreaded erode replaces the SciPy filter
+# pair for the 2D erosion when numba is not available.
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+# The edt package is optional: when present, a single parallel distance
+# transform replaces the morphological erosion altogether.
+try:
+    import edt
+except ImportError:
+    edt = None
 
 
 ## Segmentation from FreeSurfer aseg.mgz
@@ -37,92 +47,395 @@ regions_dic = {10: 'Left-Thalamus-Proper',
                54: 'Right-Amygdala',
                58: 'Right-Accumbens-area'}
 
-seg_img = nib.load(args.segmentation)
-seg_data = np.asarray(seg_img.dataobj)
-
-qsm_img = nib.load(args.qsm_in_T1)
-qsm_data = qsm_img.get_fdata()
-
-qsm_by_region = {}
-for seg_id in regions_dic.keys():
-    mask = seg_data == seg_id
-    # Apply 2D erosion slice-by-slice to match UKB pipeline (FSL -kernel 2D -ero)
-    eroded_mask = np.zeros_like(mask)
-    for z in range(mask.shape[2]):
-        eroded_mask[:, :, z] = binary_erosion(mask[:, :, z])
-    qsm_values = qsm_data[eroded_mask]
-    qsm_values = qsm_values[~np.isnan(qsm_values)]
-    qsm_by_region[regions_dic[seg_id]] = np.median(qsm_values) if len(qsm_values) > 0 else np.nan
-
-
-## Substantia nigra regions (left/right, matching UKB pipeline)
-
-sn_mask_left = nib.load(args.sn_mask_left)
-sn_left_data = sn_mask_left.get_fdata()
-
-sn_mask_right = nib.load(args.sn_mask_right)
-sn_right_data = sn_mask_right.get_fdata()
-
-qsm_in_mni = nib.load(args.qsm_in_mni152)
-qsm_mni_data = qsm_in_mni.get_fdata()
-
-# Left SN -- only positive QSM voxels (matching UKB pipeline)
-mask_sn_left = sn_left_data > 0
-qsm_values_sn_left = qsm_mni_data[mask_sn_left]
-qsm_values_sn_left = qsm_values_sn_left[~np.isnan(qsm_values_sn_left)]
-qsm_values_sn_left = qsm_values_sn_left[qsm_values_sn_left > 0]
-qsm_by_region['SN_L'] = np.median(qsm_values_sn_left) if len(qsm_values_sn_left) > 0 else np.nan
-
-# Right SN -- only positive QSM voxels
-mask_sn_right = sn_right_data > 0
-qsm_values_sn_right = qsm_mni_data[mask_sn_right]
-qsm_values_sn_right = qsm_values_sn_right[~np.isnan(qsm_values_sn_right)]
-qsm_values_sn_right = qsm_values_sn_right[qsm_values_sn_right > 0]
-qsm_by_region['SN_R'] = np.median(qsm_values_sn_right) if len(qsm_values_sn_right) > 0 else np.nan
-
-
-## WMH from lesions
-
-if args.lesions_mask and os.path.isfile(args.lesions_mask):
-    wmh_mask = nib.load(args.lesions_mask)
-    wmh_data = wmh_mask.get_fdata()
-
-    qsm_values_wmh = qsm_data[wmh_data == 1]
-    qsm_values_wmh = qsm_values_wmh[~np.isnan(qsm_values_wmh)]
-    qsm_by_region['WMH'] = np.median(qsm_values_wmh) if len(qsm_values_wmh) > 0 else np.nan
-
-    ## WM
-
-    left_white_matter = 2
-    right_white_matter = 41
-
-    wm_mask_data = np.logical_or(seg_data == left_white_matter, seg_data == right_white_matter).astype(np.uint8)
-
-    qsm_values_in_wm = qsm_data[wm_mask_data == 1]
-    qsm_values_in_wm = qsm_values_in_wm[~np.isnan(qsm_values_in_wm)]
-    qsm_by_region['WM'] = np.median(qsm_values_in_wm) if len(qsm_values_in_wm) > 0 else np.nan
-
-    ## WM without lesions
-
-    wm_without_lesions_mask = np.logical_and(wm_mask_data == 1, wmh_data == 0).astype(np.uint8)
-    qsm_values_in_wm_without_lesions = qsm_data[wm_without_lesions_mask == 1]
-    qsm_values_in_wm_without_lesions = qsm_values_in_wm_without_lesions[~np.isnan(qsm_values_in_wm_without_lesions)]
-    qsm_by_region['WM_no_lesions'] = np.median(qsm_values_in_wm_without_lesions) if len(qsm_values_in_wm_without_lesions) > 0 else np.nan
-
-    qsm_by_region['Diff-WM'] = qsm_by_region['WM'] - qsm_by_region['WMH']
-    qsm_by_region['Diff-WM-no-lesions'] = qsm_by_region['WM_no_lesions'] - qsm_by_region['WMH']
-
-
-## Add to output.csv
-
-outfile = args.output_csv
-header = ["subject", "session"] + list(qsm_by_region.keys())
-row = [args.id, args.ses] + list(qsm_by_region.values())
-
-file_exists = os.path.isfile(outfile)
-
-with open(outfile, "a", newline="", encoding="utf-8") as f:
-    writer = csv.writer(f)
-    if not file_exists:
-        writer.writerow(header)
-    writer.writerow(row)
+SUBJECT_KEYS = ['id', 'ses', 'qsm_in_T1', 'segmentation', 'qsm_in_mni152',
+                'sn_mask_left', 'sn_mask_right']
+
+
+# Above this size, _fast_median switches to a bucketed histogram median:
+# worthwhile for the multi-million-voxel WM arrays, not for the small ROIs.
+HIST_MEDIAN_MIN_SIZE = 1 << 21
+
+
+def _hist_median(values):
+    """Exact median via a 16-bit histogram over 0.0001-ppm buckets.
+
+    Quantizing to int buckets lets one bincount pass replace most of the
+    selection work; only the bucket(s) actually holding the middle order
+    statistic(s) are partitioned on the original float values, so the result
+    stays exact (quantization is monotone, so buckets are contiguous runs of
+    the sorted data).
+    """
+    n = values.size
+    buckets = (np.clip(np.rint(values * 1e4), -32768, 32767).astype(np.int32)
+               + 32768)
+    csum = np.cumsum(np.bincount(buckets, minlength=65536))
+
+    k = n // 2
+    b_hi = int(np.searchsorted(csum, k + 1))
+    in_hi = values[buckets == b_hi]
+    base_hi = int(csum[b_hi]) - in_hi.size
+
+    if n % 2:
+        r = k - base_hi
+        return np.partition(in_hi, r)[r]
+
+    b_lo = int(np.searchsorted(csum, k))
+    if b_lo == b_hi:
+        r0, r1 = k - 1 - base_hi, k - base_hi
+        p = np.partition(in_hi, [r0, r1])
+        return 0.5 * (p[r0] + p[r1])
+    # The two middle order statistics straddle a bucket boundary: k-1 is the
+    # largest value of the lower bucket, k the smallest of the upper one.
+    return 0.5 * (values[buckets == b_lo].max() + in_hi.min())
+
+
+def _fast_median(values):
+    """Median via np.partition (introselect, O(n)) instead of a full sort.
+
+    Returns NaN for empty input, matching the previous per-region guards.
+    Very large arrays go through the histogram path instead.
+    """
+    n = values.size
+    if n == 0:
+        return np.nan
+    if n >= HIST_MEDIAN_MIN_SIZE:
+        return _hist_median(values)
+    k = n // 2
+    if n % 2:
+        return np.partition(values, k)[k]
+    p = np.partition(values, [k - 1, k])
+    return 0.5 * (p[k - 1] + p[k])
+
+
+def _eroded_label_mask(seg_slab, seg_id):
+    """2D-erode the seg_id mask within a slab (3x3 box, zero border).
+
+    With the edt package, erosion becomes a thresholded distance transform:
+    one parallel pass over the whole slab, no morphology at all. With OpenCV,
+    the axial slices are tiled side-by-side into one 2D image -- separated by
+    a zero column so no slice bleeds into its neighbour -- and a single
+    cv2.erode call covers the slab. Otherwise, SciPy separable min/max
+    filters on the label values do the same job: a voxel survives only where
+    both filters return its own label.
+    """
+    if edt is not None:
+        mask = (seg_slab == seg_id).astype(np.uint8)
+        # In-plane Euclidean distance to the nearest non-label voxel: the huge
+        # z spacing keeps the transform confined to axial planes and
+        # black_border treats out-of-slab voxels as background. A voxel
+        # survives 3x3-box erosion exactly when no background voxel lies in
+        # its in-plane 8-neighbourhood, i.e. when its distance exceeds
+        # sqrt(2); the next achievable grid distance is 2, so thresholding at
+        # 1.5 is exact.
+        dist = edt.edt(mask, anisotropy=(1.0, 1.0, 1e6),
+                       black_border=True, parallel=0)
+        return dist >= 1.5
+
+    if cv2 is not None:
+        mask = (seg_slab == seg_id)
+        nx, ny, nz = mask.shape
+        tiled = np.zeros((nx, nz, ny + 1), dtype=np.uint8)
+        tiled[:, :, :ny] = mask.transpose(0, 2, 1)
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+        eroded = cv2.erode(tiled.reshape(nx, nz * (ny + 1)), kernel,
+                           borderType=cv2.BORDER_CONSTANT, borderValue=0)
+        return (eroded.reshape(nx, nz, ny + 1)[:, :, :ny]
+                .transpose(0, 2, 1).astype(bool))
+
+    label_min = minimum_filter1d(seg_slab, 3, axis=0, mode='constant', cval=0)
+    label_min = minimum_filter1d(label_min, 3, axis=1, mode='constant', cval=0)
+    label_max = maximum_filter1d(seg_slab, 3, axis=0, mode='constant', cval=0)
+    label_max = maximum_filter1d(label_max, 3, axis=1, mode='constant', cval=0)
+    return (label_min == seg_id) & (label_max == seg_id)
+
+
+if _HAVE_NUMBA:
+    @njit(cache=True)
+    def _survives_erosion(seg, x, y, z, seg_id):
+        """True where all 8 in-plane neighbours carry seg_id (3x3 box)."""
+        return (seg[x - 1, y - 1, z] == seg_id and
+                seg[x - 1, y, z] == seg_id and
+                seg[x - 1, y + 1, z] == seg_id and
+                seg[x, y - 1, z] == seg_id and
+                seg[x, y + 1, z] == seg_id and
+                seg[x + 1, y - 1, z] == seg_id and
+                seg[x + 1, y, z] == seg_id and
+                seg[x + 1, y + 1, z] == seg_id)
+
+    @functools.lru_cache(maxsize=64)
+    def _get_eroded_values_kernel(nx, ny, nz):
+        """JIT-specialize the erosion + gather sweep for one slab shape.
+
+        UKB grids are stable (FreeSurfer's conformed space is 256^3, MNI152
+        1mm is fixed, and the SN slabs come from the same atlas masks for
+        every subject), so slab shapes repeat across subjects. Freezing the
+        loop bounds into the compiled kernel as constants lets LLVM unroll
+        and vectorize the inner label comparisons; the lru_cache keeps one
+        compiled kernel per shape seen. boundscheck is off since the bounds
+        are the compile-time constants themselves; fastmath is deliberately
+        not used because the sweep must honour NaNs.
+        """
+        @njit(parallel=True, boundscheck=False)
+        def _eroded_label_values(seg, qsm, seg_id):
+            # Gathers non-NaN QSM values for seg_id voxels that survive 2D
+            # erosion, fusing the erosion test, label mask and NaN filter
+            # into one sweep over the slab. Axial slices run in parallel: a
+            # count pass sizes the output, a cumulative offset per slice
+            # removes any write contention, and a second pass fills the
+            # values. Voxels on the slab boundary are skipped, matching
+            # erosion with a zero border.
+            counts = np.zeros(nz, dtype=np.int64)
+            for z in prange(nz):
+                c = 0
+                for x in range(1, nx - 1):
+                    for y in range(1, ny - 1):
+                        if (seg[x, y, z] == seg_id
+                                and _survives_erosion(seg, x, y, z, seg_id)
+                                and not np.isnan(qsm[x, y, z])):
+                            c += 1
+                counts[z] = c
+            offsets = np.zeros(nz + 1, dtype=np.int64)
+            for z in range(nz):
+                offsets[z + 1] = offsets[z] + counts[z]
+            out = np.empty(offsets[nz], dtype=np.float32)
+            for z in prange(nz):
+                k = offsets[z]
+                for x in range(1, nx - 1):
+                    for y in range(1, ny - 1):
+                        if (seg[x, y, z] == seg_id
+                                and _survives_erosion(seg, x, y, z, seg_id)
+                                and not np.isnan(qsm[x, y, z])):
+                            out[k] = qsm[x, y, z]
+                            k += 1
+            return out
+
+        return _eroded_label_values
+
+
+def process_subject(subject):
+    """Extract all region-wise QSM medians for one subject/session.
+
+    `subject` is a dict with the keys in SUBJECT_KEYS (plus an optional
+    'lesions_mask'). Returns the output CSV row as a dict, starting with
+    'subject' and 'session'.
+    """
+
+    ## Segmentation from FreeSurfer aseg.mgz
+
+    # Load the segmentation at working precision rather than via get_fdata(),
+    # which upcasts to float64: int16 is plenty for FreeSurfer labels. The QSM
+    # volumes are kept as lazy nibabel proxies and read slab-by-slab below.
+    seg_img = nib.load(subject['segmentation'])
+    seg_data = np.asarray(seg_img.dataobj, dtype=np.int16)
+
+    qsm_img = nib.load(subject['qsm_in_T1'])
+
+    # One pass over the segmentation builds a label -> voxel-indices map that
+    # is consulted for every downstream region: the ROI bounding boxes here
+    # and the WM voxel gather below, instead of re-scanning seg_data once per
+    # label.
+    label_indices = value_indices(seg_data, ignore_value=0)
+
+    # The subcortical ROIs cover well under 1% of the volume, so rather than
+    # materialising the full QSM volume just to pull out each region's voxels,
+    # take every label's bounding box from the index map and lazily read only
+    # that slab through qsm_img.dataobj.
+    # One scratch buffer, sized to the largest ROI present, is reused for
+    # every label's gathered values so the allocator is not hit once per
+    # label (the numba kernel already returns exact-size arrays).
+    if not _HAVE_NUMBA:
+        max_roi_voxels = max((label_indices[seg_id][0].size
+                              for seg_id in regions_dic if seg_id in label_indices),
+                             default=0)
+        scratch = np.empty(max_roi_voxels, dtype=np.float32)
+
+    qsm_by_region = {}
+    for seg_id in sorted(regions_dic.keys()):
+        if seg_id not in label_indices:
+            qsm_by_region[regions_dic[seg_id]] = np.nan
+            continue
+
+        slab = tuple(slice(ix.min(), ix.max() + 1) for ix in label_indices[seg_id])
+        seg_slab = seg_data[slab]
+        qsm_slab = np.asarray(qsm_img.dataobj[slab], dtype=np.float32)
+
+        # Apply 2D erosion to match UKB pipeline (FSL -kernel 2D -ero, a 3x3x1
+        # box). Eroding within the slab is exact: the bounding box is tight,
+        # so any out-of-slab neighbour carries a different label.
+        if _HAVE_NUMBA:
+            # Single compiled sweep fusing erosion, masking and NaN
+            # filtering, specialized (and cached) for this slab shape.
+            kernel = _get_eroded_values_kernel(*seg_slab.shape)
+            qsm_values = kernel(np.ascontiguousarray(seg_slab), qsm_slab, seg_id)
+        else:
+            eroded_mask = _eroded_label_mask(seg_slab, seg_id)
+            # Gather into the shared scratch buffer instead of allocating a
+            # fresh fancy-index result, then compact the NaNs away in place.
+            idx = np.flatnonzero(eroded_mask.ravel())
+            n = idx.size
+            np.take(qsm_slab.ravel(), idx, out=scratch[:n])
+            gathered = scratch[:n]
+            valid = ~np.isnan(gathered)
+            n_valid = int(np.count_nonzero(valid))
+            if n_valid != n:
+                gathered[:n_valid] = gathered[valid]
+            qsm_values = gathered[:n_valid]
+        qsm_by_region[regions_dic[seg_id]] = _fast_median(qsm_values)
+
+    ## Substantia nigra regions (left/right, matching UKB pipeline)
+
+    sn_mask_left = nib.load(subject['sn_mask_left'])
+    sn_left_data = np.asarray(sn_mask_left.dataobj, dtype=np.uint8)
+
+    sn_mask_right = nib.load(subject['sn_mask_right'])
+    sn_right_data = np.asarray(sn_mask_right.dataobj, dtype=np.uint8)
+
+    qsm_in_mni = nib.load(subject['qsm_in_mni152'])
+
+    # The SN masks are tiny, so read only their bounding-box slab of the
+    # MNI-space QSM rather than the full volume.
+
+    # Left SN -- only positive QSM voxels (matching UKB pipeline)
+    sn_left_objects = find_objects((sn_left_data > 0).view(np.uint8))
+    if sn_left_objects and sn_left_objects[0] is not None:
+        slab = sn_left_objects[0]
+        qsm_slab = np.asarray(qsm_in_mni.dataobj[slab], dtype=np.float32)
+        # Combine the mask, NaN and positivity conditions into one boolean
+        # mask so the values are extracted in a single indexing pass (qsm > 0
+        # is False for NaN, so no separate NaN filter is needed).
+        mask_sn_left = (sn_left_data[slab] > 0) & (qsm_slab > 0)
+        qsm_values_sn_left = qsm_slab[mask_sn_left]
+        qsm_by_region['SN_L'] = _fast_median(qsm_values_sn_left)
+    else:
+        qsm_by_region['SN_L'] = np.nan
+
+    # Right SN -- only positive QSM voxels
+    sn_right_objects = find_objects((sn_right_data > 0).view(np.uint8))
+    if sn_right_objects and sn_right_objects[0] is not None:
+        slab = sn_right_objects[0]
+        qsm_slab = np.asarray(qsm_in_mni.dataobj[slab], dtype=np.float32)
+        mask_sn_right = (sn_right_data[slab] > 0) & (qsm_slab > 0)
+        qsm_values_sn_right = qsm_slab[mask_sn_right]
+        qsm_by_region['SN_R'] = _fast_median(qsm_values_sn_right)
+    else:
+        qsm_by_region['SN_R'] = np.nan
+
+    ## WMH from lesions
+
+    lesions_mask = subject.get('lesions_mask')
+    if lesions_mask and os.path.isfile(lesions_mask):
+        wmh_mask = nib.load(lesions_mask)
+        wmh_data = np.asarray(wmh_mask.dataobj, dtype=np.uint8)
+
+        # WM spans a large fraction of the volume, so this is the one place
+        # the full T1-space QSM volume is actually materialised (float32).
+        qsm_data = np.asarray(qsm_img.dataobj, dtype=np.float32)
+
+        left_white_matter = 2
+        right_white_matter = 41
+
+        # Consult the hoisted label->indices map instead of re-scanning the
+        # segmentation for the two WM labels: one concatenation yields every
+        # WM voxel's flat index, and the lesion flags at those same indices
+        # split WM into its with/without-lesion parts in the same traversal.
+        wm_index_arrays = [np.ravel_multi_index(label_indices[lab], seg_data.shape)
+                           for lab in (left_white_matter, right_white_matter)
+                           if lab in label_indices]
+        wm_flat_idx = (np.concatenate(wm_index_arrays) if wm_index_arrays
+                       else np.empty(0, dtype=np.intp))
+
+        qsm_flat = qsm_data.ravel()
+        # Compare against the lesion label once and index with the boolean
+        # result directly, rather than repeating the == 1 comparison pass for
+        # the WMH gather and again for the WM lesion split.
+        is_wmh = wmh_data.ravel() == 1
+
+        qsm_values_wmh = qsm_flat[is_wmh]
+        qsm_values_wmh = qsm_values_wmh[~np.isnan(qsm_values_wmh)]
+        qsm_by_region['WMH'] = _fast_median(qsm_values_wmh)
+
+        qsm_values_in_wm = qsm_flat[wm_flat_idx]
+        wm_is_lesion = is_wmh[wm_flat_idx]
+        qsm_wm_only = qsm_values_in_wm[~wm_is_lesion]
+
+        qsm_values_in_wm = qsm_values_in_wm[~np.isnan(qsm_values_in_wm)]
+        qsm_by_region['WM'] = _fast_median(qsm_values_in_wm)
+
+        qsm_wm_only = qsm_wm_only[~np.isnan(qsm_wm_only)]
+        qsm_by_region['WM_no_lesions'] = _fast_median(qsm_wm_only)
+
+        qsm_by_region['Diff-WM'] = qsm_by_region['WM'] - qsm_by_region['WMH']
+        qsm_by_region['Diff-WM-no-lesions'] = qsm_by_region['WM_no_lesions'] - qsm_by_region['WMH']
+
+    return {'subject': subject['id'], 'session': subject['ses'], **qsm_by_region}
+
+
+# How many result rows to buffer before handing them to the csv writer and
+# flushing, so long manifest runs make progress durable without a write
+# syscall per subject.
+CSV_BATCH_ROWS = 256
+
+
+def _append_rows(outfile, rows):
+    """Append result rows to the output CSV, writing the header once.
+
+    The file is opened a single time for the whole run; whether the header is
+    needed comes from the opened file's position ('a+' seeks to the end)
+    rather than a separate os.path.isfile stat, and rows are written in
+    batches of CSV_BATCH_ROWS.
+    """
+    with open(outfile, "a+", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        need_header = f.tell() == 0
+        batch = []
+        for row in rows:
+            if need_header:
+                writer.writerow(list(row.keys()))
+                need_header = False
+            batch.append(list(row.values()))
+            if len(batch) >= CSV_BATCH_ROWS:
+                writer.writerows(batch)
+                batch.clear()
+                f.flush()
+        if batch:
+            writer.writerows(batch)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Extract QSM values per brain region from segmentation data.')
+
+    parser.add_argument('--id', type=int, help="ID")
+    parser.add_argument('--ses', type=int, help="session")
+    parser.add_argument('--qsm_in_T1', type=str, help="Path to the QSM in T1 space NIfTI file")
+    parser.add_argument('--segmentation', type=str, help="Path to the segmentation MGZ file")
+    parser.add_argument('--qsm_in_mni152', type=str, help="Path to the QSM in MNI152 space NIfTI file")
+    parser.add_argument('--lesions_mask', type=str, help="Path to the lesions mask in T1 space NIfTI file")
+    parser.add_argument('--sn_mask_left', type=str, help="Path to the left SN mask in MNI space")
+    parser.add_argument('--sn_mask_right', type=str, help="Path to the right SN mask in MNI space")
+    parser.add_argument('--manifest', type=str,
+                        help="Path to a CSV manifest with one subject per row (columns: "
+                             "id, ses, qsm_in_T1, segmentation, qsm_in_mni152, sn_mask_left, "
+                             "sn_mask_right and optionally lesions_mask); processes all "
+                             "subjects in parallel within one interpreter")
+    parser.add_argument('--output_csv', type=str, help="Path to the output CSV file", required=True)
+
+    args = parser.parse_args()
+
+    if args.manifest:
+        # Batch mode: amortise the Python/nibabel/scipy import cost over all
+        # subjects and fan out across cores. All CSV writes stay in the
+        # parent process so append semantics are preserved.
+        with open(args.manifest, newline="", encoding="utf-8") as f:
+            subjects = list(csv.DictReader(f))
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            _append_rows(args.output_csv, executor.map(process_subject, subjects))
+    else:
+        missing = [key for key in SUBJECT_KEYS if getattr(args, key) is None]
+        if missing:
+            parser.error("without --manifest, the following arguments are required: "
+                         + ", ".join("--" + key for key in missing))
+        _append_rows(args.output_csv, [process_subject(vars(args))])
+
+
+if __name__ == "__main__":
+    main()
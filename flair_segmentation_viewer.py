@@ -8,12 +8,16 @@ Automatically selects a representative axial slice based on segmentation content
 
 import glob
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
 import nibabel as nib
 import numpy as np
+import matplotlib
+matplotlib.use("Agg")  # headless backend; figures are rendered in worker processes
 import matplotlib.pyplot as plt
 from matplotlib.colors import ListedColormap
+from PIL import Image
 
 # =============================================================================
 # CONFIGURE THESE GLOB PATTERNS
@@ -89,23 +93,15 @@ def select_axial_slice(seg_data, method="median"):
     int
         Selected slice index, or None if no segmentation present
     """
-    n_slices = seg_data.shape[2]
+    # Count non-zero voxels per axial slice in one vectorized pass instead of
+    # a Python loop over slices
+    counts = np.count_nonzero(seg_data, axis=(0, 1))
 
-    # Count non-zero voxels per axial slice
-    voxel_counts = []
-    slice_indices = []
-
-    for z in range(n_slices):
-        count = np.sum(seg_data[:, :, z] > 0)
-        if count > 0:
-            voxel_counts.append(count)
-            slice_indices.append(z)
-
-    if len(voxel_counts) == 0:
+    slice_indices = np.flatnonzero(counts)
+    if slice_indices.size == 0:
         return None
 
-    voxel_counts = np.array(voxel_counts)
-    slice_indices = np.array(slice_indices)
+    voxel_counts = counts[slice_indices]
 
     median_count = np.median(voxel_counts)
 
@@ -128,9 +124,11 @@ def select_axial_slice(seg_data, method="median"):
 def window_image(img_data, low_pct=5, high_pct=95):
     """
     Apply percentile-based windowing to image data.
+
+    Called on a single 2D slice, so the quantiles are never computed over the
+    full volume; both are taken in one partition pass.
     """
-    low_val = np.percentile(img_data, low_pct)
-    high_val = np.percentile(img_data, high_pct)
+    low_val, high_val = np.quantile(img_data, [low_pct / 100.0, high_pct / 100.0])
 
     windowed = np.clip(img_data, low_val, high_val)
     windowed = (windowed - low_val) / (high_val - low_val + 1e-8)
@@ -138,30 +136,27 @@ def window_image(img_data, low_pct=5, high_pct=95):
     return windowed
 
 
-def create_overlay_figure(flair_slice, seg_slice, n_labels):
-    """
-    Create a side-by-side figure: raw FLAIR on left, overlay on right.
+def create_overlay_image(flair_slice, seg_slice, n_labels):
     """
-    fig, axes = plt.subplots(1, 2, figsize=(12, 6))
+    Create a side-by-side preview (raw FLAIR left, overlay right) as a PIL image.
 
-    # Left: Raw FLAIR slice
-    axes[0].imshow(flair_slice.T, cmap="gray", origin="lower")
-    axes[0].set_title("FLAIR")
-    axes[0].axis("off")
-
-    # Right: FLAIR with segmentation overlay
-    axes[1].imshow(flair_slice.T, cmap="gray", origin="lower")
+    Composites the overlay directly from a colormap lookup table instead of
+    rendering a matplotlib figure, skipping the figure, layout and font
+    machinery entirely.
+    """
+    # Match imshow(..., origin="lower"): transpose, then put row 0 at the bottom
+    flair_u8 = (np.clip(flair_slice, 0.0, 1.0) * 255).astype(np.uint8).T[::-1]
+    base = Image.fromarray(flair_u8, "L").convert("RGBA")
 
-    # Only show overlay where segmentation exists
-    seg_masked = np.ma.masked_where(seg_slice == 0, seg_slice)
+    # Label 0 is transparent in the colormap, so the composite only shows the
+    # overlay where segmentation exists
     cmap = get_qualitative_cmap(n_labels)
-    axes[1].imshow(seg_masked.T, cmap=cmap, origin="lower",
-                   vmin=0, vmax=n_labels, interpolation="nearest")
-    axes[1].set_title("FLAIR + Segmentation")
-    axes[1].axis("off")
+    lut = (cmap(np.arange(n_labels + 1)) * 255).astype(np.uint8)
+    overlay = Image.fromarray(lut[np.clip(seg_slice, 0, n_labels).T[::-1]], "RGBA")
 
-    plt.tight_layout()
-    return fig
+    composite = Image.alpha_composite(base, overlay)
+    side_by_side = np.hstack([np.asarray(base), np.asarray(composite)])
+    return Image.fromarray(side_by_side, "RGBA")
 
 
 def process_pair(flair_path, seg_path, output_dir, method="median"):
@@ -181,7 +176,9 @@ def process_pair(flair_path, seg_path, output_dir, method="median"):
     seg_img = nib.load(seg_path)
 
     flair_data = flair_img.get_fdata()
-    seg_data = seg_img.get_fdata().astype(int)
+    # Read labels as int16 directly instead of a float64 get_fdata() pass
+    # followed by an astype copy
+    seg_data = np.asarray(seg_img.dataobj, dtype=np.int16)
 
     # Verify shapes match
     if flair_data.shape != seg_data.shape:
@@ -207,19 +204,19 @@ def process_pair(flair_path, seg_path, output_dir, method="median"):
         high_pct=WINDOW_PERCENTILE_HIGH
     )
 
-    # Get number of unique labels (excluding 0)
-    unique_labels = np.unique(seg_data)
-    n_labels = int(unique_labels[unique_labels > 0].max()) if len(unique_labels) > 1 else 1
+    # Get number of labels (excluding 0): labels are small non-negative ints,
+    # so the max is all that's needed -- np.unique would sort the whole
+    # volume just to read off its last element
+    n_labels = int(seg_data.max()) or 1
 
-    # Create figure
-    fig = create_overlay_figure(flair_windowed, seg_slice, n_labels)
+    # Create preview image
+    preview = create_overlay_image(flair_windowed, seg_slice, n_labels)
 
     # Generate output filename
     stem = flair_path.name.replace(".nii.gz", "").replace(".nii", "")
     output_path = Path(output_dir) / f"{stem}_segmentation_preview.png"
 
-    fig.savefig(output_path, dpi=150, bbox_inches="tight", facecolor="black")
-    plt.close(fig)
+    preview.save(output_path, "PNG", optimize=True)
 
     return str(output_path)
 
@@ -240,20 +237,25 @@ def main():
     print(f"Output directory: {output_dir}")
     print()
 
+    # Each pair is independent (disk-bound nii.gz decompression plus
+    # CPU-bound rendering), so fan the pairs out over a process pool and
+    # report results as they complete.
     successful = 0
-    for i, (flair_path, seg_path) in enumerate(zip(FLAIR_IMAGES, SEGMENTATIONS)):
-        print(f"[{i+1}/{len(FLAIR_IMAGES)}] Processing {Path(flair_path).name}...")
-
-        result = process_pair(
-            flair_path,
-            seg_path,
-            output_dir,
-            method=SLICE_SELECTION_METHOD
-        )
-
-        if result:
-            print(f"  -> Saved: {result}")
-            successful += 1
+    done = 0
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = {
+            executor.submit(process_pair, flair_path, seg_path, output_dir,
+                            SLICE_SELECTION_METHOD): flair_path
+            for flair_path, seg_path in zip(FLAIR_IMAGES, SEGMENTATIONS)
+        }
+        for future in as_completed(futures):
+            done += 1
+            print(f"[{done}/{len(FLAIR_IMAGES)}] Processed {Path(futures[future]).name}")
+
+            result = future.result()
+            if result:
+                print(f"  -> Saved: {result}")
+                successful += 1
 
     print()
     print(f"Done! Successfully processed {successful}/{len(FLAIR_IMAGES)} pairs.")